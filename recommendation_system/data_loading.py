@@ -1,3 +1,8 @@
+from collections import defaultdict
+
+import numpy as np
+
+
 def load_data():
     """Loads sample data for users, products, browsing history, purchase history, and contextual signals."""
     users = {
@@ -52,8 +57,49 @@ def build_index(users, products):
     return user_index, product_index
 
 
+def build_reverse_index(index):
+    """Builds an array mapping index positions back to their ids."""
+    return np.asarray(list(index.keys()))
+
+
+def build_index_lookup(index, max_id=1_000_000):
+    """Builds an array mapping small non-negative integer ids to their index positions (-1 for unknown ids).
+
+    Returns None when the ids are not integers below max_id, in which case callers fall back to the dict index.
+    """
+    ids = np.asarray(list(index.keys()))
+    if ids.dtype.kind not in "iu" or (ids.size and (ids.min() < 0 or ids.max() >= max_id)):
+        return None
+
+    lookup = np.full(ids.max() + 1 if ids.size else 0, -1, dtype=np.intp)
+    lookup[ids] = np.fromiter(index.values(), dtype=np.intp, count=len(index))
+    return lookup
+
+
+def build_history_product_ids(history):
+    """Builds arrays of the product ids in each user's browsing or purchase history, keeping the ids' natural dtype.
+
+    Users with an empty history are left out, as an empty array would get NumPy's float64 default instead of the ids'
+    dtype.
+    """
+    return {user_id: np.array([entry[0] for entry in entries]) for user_id, entries in history.items() if entries}
+
+
+def build_product_attribute_index(products):
+    """Builds mappings from each category and each suitable device to the ids of matching products."""
+    category_to_products = defaultdict(list)
+    device_to_products = defaultdict(list)
+    for product_id, product in products.items():
+        category_to_products[product["category"]].append(product_id)
+        for device in product["device_suitability"]:
+            device_to_products[device].append(product_id)
+    return dict(category_to_products), dict(device_to_products)
+
+
 def extract_tags_and_categories(products):
-    """Extracts unique product tags and categories."""
+    """Builds index mappings for unique product tags and categories."""
     all_tags = {tag for product in products.values() for tag in product["tags"]}
     all_categories = {product["category"] for product in products.values()}
-    return list(all_tags), list(all_categories)
\ No newline at end of file
+    tag_index = {tag: idx for idx, tag in enumerate(sorted(all_tags))}
+    category_index = {category: idx for idx, category in enumerate(sorted(all_categories))}
+    return tag_index, category_index
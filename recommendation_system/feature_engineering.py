@@ -1,59 +1,103 @@
-import json
+import hashlib
 import logging
-import sys
-from concurrent.futures import as_completed, ProcessPoolExecutor
 
 import numpy as np
 import redis
+from scipy.sparse import csr_matrix
 
-from .setup import redis_client
+from .setup import binary_redis_client
 
 
-def create_product_feature_vector(product, all_tags, all_categories):
+def _feature_positions(product, tag_index, category_index):
+    """Returns the feature vector positions set by a product's tags and category."""
+    try:
+        positions = [tag_index[tag] for tag in product["tags"]]
+        positions.append(len(tag_index) + category_index[product["category"]])
+    except KeyError as e:
+        raise ValueError(f"Unknown product tag or category: {e}") from e
+    return positions
+
+
+def create_product_feature_vector(product, tag_index, category_index):
     """Creates a feature vector for a product based on its tags and category."""
-    tag_vector = np.zeros(len(all_tags))
-    category_vector = np.zeros(len(all_categories))
+    vector = np.zeros(len(tag_index) + len(category_index), dtype=np.float32)
+    vector[_feature_positions(product, tag_index, category_index)] = 1.0
+    return vector
+
+
+def l2_normalize(array):
+    """Scales vectors (the last axis of the array) to unit L2 norm, leaving all-zero vectors unchanged."""
+    norms = np.linalg.norm(array, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return array / norms
+
+
+def vocabulary_fingerprint(tag_index, category_index):
+    """Returns a stable digest of the tag and category positions that define the feature vector layout."""
+    digest = hashlib.blake2b(digest_size=8)
+    for index in (tag_index, category_index):
+        digest.update(repr(sorted(index.items(), key=lambda item: item[1])).encode())
+    return digest.hexdigest()
+
+
+def _product_feature_cache_key(product_id, fingerprint):
+    """Returns the cache key of a product feature vector laid out by the vocabulary with the given fingerprint."""
+    return f"product_feature:{product_id}:{fingerprint}"
 
-    for tag in product["tags"]:
-        tag_vector[all_tags.index(tag)] = 1
-    category_vector[all_categories.index(product["category"])] = 1
 
-    return np.concatenate((tag_vector, category_vector))
+def build_sparse_product_feature_matrix(products, product_index, tag_index, category_index):
+    """Builds the one-hot feature vectors of all products as a CSR matrix whose rows follow product_index."""
+    rows, cols = [], []
+    for product_id, product in products.items():
+        positions = _feature_positions(product, tag_index, category_index)
+        rows.extend([product_index[product_id]] * len(positions))
+        cols.extend(positions)
 
+    matrix = csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)),
+                        shape=(len(product_index), len(tag_index) + len(category_index)))
+    matrix.data[:] = 1  # Duplicate entries from a repeated tag are summed, but the feature is still one-hot
+    return matrix
 
-def get_product_feature_vector(product_id, product, all_tags, all_categories):
-    """Retrieves or computes and caches the product feature vector."""
-    cache_key = f"product_feature:{product_id}"
+
+def build_product_feature_matrix(products, product_index, tag_index, category_index):
+    """Builds the feature vectors of all products as one matrix whose rows follow product_index."""
+    return build_sparse_product_feature_matrix(products, product_index, tag_index, category_index).toarray()
+
+
+def bulk_get_product_feature_vectors(products, product_index, tag_index, category_index):
+    """Retrieves the product feature matrix with a single MGET, computing and caching only the misses."""
+    num_features = len(tag_index) + len(category_index)
+    # Keying on the vocabulary, not just its size, keeps vectors with reordered or renamed columns from being served
+    fingerprint = vocabulary_fingerprint(tag_index, category_index)
+    cache_keys = [_product_feature_cache_key(product_id, fingerprint) for product_id in products]
 
     try:
-        cached_vector = redis_client.get(cache_key)
+        cached_vectors = binary_redis_client.mget(cache_keys)
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}. Falling back to computing product feature vectors without caching.")
+        return build_product_feature_matrix(products, product_index, tag_index, category_index)
 
+    feature_matrix = np.zeros((len(product_index), num_features), dtype=np.float32)
+    missing_products = {}
+    for (product_id, product), cached_vector in zip(products.items(), cached_vectors):
         if cached_vector:
-            return np.array(json.loads(cached_vector))
+            feature_matrix[product_index[product_id]] = np.frombuffer(cached_vector, dtype=np.float32)
+        else:
+            missing_products[product_id] = product
 
-        vector = create_product_feature_vector(product, all_tags, all_categories)
-        redis_client.setex(cache_key, 86400, json.dumps(vector.tolist()))  # Cache for 24 hours
-        return vector
+    if not missing_products:
+        return feature_matrix
+
+    missing_index = {product_id: idx for idx, product_id in enumerate(missing_products)}
+    missing_matrix = build_product_feature_matrix(missing_products, missing_index, tag_index, category_index)
+    feature_matrix[[product_index[product_id] for product_id in missing_products]] = missing_matrix
+
+    try:
+        with binary_redis_client.pipeline(transaction=False) as pipe:
+            for product_id, vector in zip(missing_products, missing_matrix):
+                pipe.setex(_product_feature_cache_key(product_id, fingerprint), 86400, vector.tobytes())
+            pipe.execute()  # Cache for 24 hours
     except redis.RedisError as e:
-        logging.error(f"Redis error: {e}. Falling back to computing product feature vector without caching.")
-        return create_product_feature_vector(product, all_tags, all_categories)
-
-
-def compute_product_feature_vectors_parallel(products, all_tags, all_categories):
-    """Compute product feature vectors in parallel."""
-    if 'pytest' in sys.modules:
-        return {pid: get_product_feature_vector(pid, product, all_tags, all_categories) for pid, product in
-                products.items()}
-    product_feature_vectors = {}
-    with ProcessPoolExecutor() as executor:
-        futures = {
-            executor.submit(get_product_feature_vector, pid, product, all_tags, all_categories): pid
-            for pid, product in products.items()
-        }
-        for future in as_completed(futures):
-            pid = futures[future]
-            try:
-                product_feature_vectors[pid] = future.result()
-            except Exception as e:
-                logging.error(f"Error computing feature vector for product {pid}: {e}")
-    return product_feature_vectors
+        logging.error(f"Redis error: {e}. Product feature vectors were computed but not cached.")
+
+    return feature_matrix
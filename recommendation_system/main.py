@@ -1,18 +1,21 @@
-import json
 import logging
 import os
-import sys
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from collections import defaultdict
-from scipy.sparse import csr_matrix
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
-from recommendation_system.data_loading import extract_tags_and_categories, build_index, load_data
-from recommendation_system.feature_engineering import compute_product_feature_vectors_parallel
+import numpy as np
+import orjson
+from scipy.sparse import coo_matrix, csr_matrix
+
+from recommendation_system.data_loading import extract_tags_and_categories, build_index, build_reverse_index, \
+    build_product_attribute_index, build_history_product_ids, load_data
+from recommendation_system.feature_engineering import bulk_get_product_feature_vectors, l2_normalize
 from recommendation_system.matrix_factorization import get_svd_factors
 from recommendation_system.recommendation_algorithms import recommend_products_device_based, \
-    recommend_products_time_based, recommend_products_cbf, recommend_products_mf, recommend_popular_trending_products
+    recommend_products_time_based, recommend_products_cbf, recommend_products_mf, recommend_popular_trending_products, \
+    rank_unpurchased_products, merge_source_scores, cosine_scores
 from recommendation_system.setup import redis_client
-from recommendation_system.user_profiles import compute_user_profiles_parallel
+from recommendation_system.user_profiles import compute_user_profiles
 
 # Explanation templates for recommendations
 EXPLANATION_TEMPLATES = {
@@ -23,52 +26,83 @@ EXPLANATION_TEMPLATES = {
     "device_based": "Recommended because it's suitable for your device.",
 }
 
+# Source weights for the hybrid recommender, read from the environment once at import
+WEIGHTS = {
+    "mf": float(os.getenv('MF_WEIGHT', 0.5)),
+    "cbf": float(os.getenv('CBF_WEIGHT', 0.4)),
+    "popular": float(os.getenv('POPULAR_WEIGHT', 0.3)),
+    "time_based": float(os.getenv('TIME_BASE_WEIGHT', 0.2)),
+    "device_based": float(os.getenv('DEVICE_WEIGHT', 0.2)),
+}
 
-def compute_product_popularity(purchase_history, products, rating_weight=0.7, frequency_weight=0.3):
-    """Precomputes product popularity based on purchase frequency and product ratings."""
-    product_popularity = defaultdict(float)
-    purchase_frequency = defaultdict(int)
+NEW_USER_WEIGHTS = {
+    "mf": float(os.getenv('NEW_USER_MF_WEIGHT', 0.0)),
+    "cbf": float(os.getenv('NEW_USER_CBF_WEIGHT', 0.0)),
+    "popular": float(os.getenv('NEW_USER_POPULAR_WEIGHT', 0.5)),
+    "time_based": float(os.getenv('NEW_USER_TIME_BASE_WEIGHT', 0.3)),
+    "device_based": float(os.getenv('NEW_USER_DEVICE_WEIGHT', 0.2)),
+}
 
-    # Compute purchase frequency
-    for purchases in purchase_history.values():
-        for product_id, _, _ in purchases:
-            purchase_frequency[product_id] += 1
+# Recommendation sources in merge order; a product's source mask has bit i set when SOURCES[i] recommended it
+SOURCES = ("mf", "cbf", "popular", "time_based", "device_based")
 
-    # Compute weighted popularity score
-    for product_id in purchase_frequency:
-        rating = products[product_id]["rating"]
-        frequency = purchase_frequency[product_id]
-        product_popularity[product_id] = (rating_weight * rating) + (frequency_weight * frequency)
+# Pre-joined explanations for every combination of sources, indexed by source mask
+EXPLANATIONS_BY_MASK = [
+    ", ".join([EXPLANATION_TEMPLATES[source] for bit, source in enumerate(SOURCES) if mask & (1 << bit)])
+    for mask in range(1 << len(SOURCES))
+]
 
-    # Normalize popularity scores
-    max_popularity = max(product_popularity.values(), default=1)
-    for product_id in product_popularity:
-        product_popularity[product_id] /= max_popularity
 
-    return sorted(product_popularity.items(), key=lambda x: x[1], reverse=True)
+def compute_product_popularity(purchase_history, products, product_index, rating_weight=0.7, frequency_weight=0.3):
+    """Precomputes product popularity based on purchase frequency and product ratings."""
+    purchased_rows = np.fromiter((product_index[product_id] for purchases in purchase_history.values()
+                                  for product_id, _, _ in purchases), dtype=np.intp)
+    purchase_frequency = np.bincount(purchased_rows, minlength=len(product_index))
+    ratings = np.fromiter((products[product_id]["rating"] for product_id in product_index), dtype=np.float32,
+                          count=len(product_index))
+
+    # Only purchased products are ranked, scored by weighted rating and frequency and normalized by the maximum
+    purchased = np.flatnonzero(purchase_frequency)
+    product_popularity = (rating_weight * ratings[purchased]
+                          + frequency_weight * purchase_frequency[purchased]).astype(np.float32)
+    if len(product_popularity):
+        product_popularity /= product_popularity.max()
+
+    order = np.argsort(-product_popularity, kind="stable")
+    product_ids = build_reverse_index(product_index)
+    return list(zip(product_ids[purchased[order]].tolist(), product_popularity[order].tolist()))
 
 
 def create_sparse_user_item_matrix(purchase_history, user_index, product_index):
     """Creates a sparse matrix where rows represent users and columns represent products."""
-    rows, cols, data = [], [], []
+    # The (user row, product column) triples are flattened into arrays and assembled as COO, then converted once
+    purchase_counts = np.fromiter(map(len, purchase_history.values()), dtype=np.intp, count=len(purchase_history))
+    rows = np.repeat(np.fromiter((user_index[user_id] for user_id in purchase_history), dtype=np.int32,
+                                 count=len(purchase_history)), purchase_counts)
+    cols = np.fromiter((product_index[product_id] for purchases in purchase_history.values()
+                        for product_id, _, _ in purchases), dtype=np.int32, count=int(purchase_counts.sum()))
+    data = np.ones(len(cols), dtype=np.float32)
 
-    for user_id, purchases in purchase_history.items():
-        for product_id, _, _ in purchases:
-            rows.append(user_index[user_id])
-            cols.append(product_index[product_id])
-            data.append(1)
-
-    return csr_matrix((data, (rows, cols)), shape=(len(user_index), len(product_index)))
+    return coo_matrix((data, (rows, cols)), shape=(len(user_index), len(product_index))).tocsr()
 
 
 def cache_recommendations(user_id, season_input, recommendations, ttl=3600):
     """Caches recommendations in Redis."""
     cache_key = f"recommendations:{user_id}:{','.join(season_input)}"
+    index_key = f"user_cache_index:{user_id}"
 
     try:
-        redis_client.setex(cache_key, ttl, json.dumps(recommendations, ensure_ascii=False))
-    except (TypeError, json.JSONDecodeError) as e:
+        payload = orjson.dumps(recommendations)
+    except orjson.JSONEncodeError as e:
         logging.error(f"Failed to serialize recommendations for caching: {e}")
+        return
+
+    # Record the key in the user's index set so it can be cleared without scanning the keyspace
+    with redis_client.pipeline(transaction=False) as pipe:
+        pipe.setex(cache_key, ttl, payload)
+        pipe.sadd(index_key, cache_key)
+        pipe.expire(index_key, ttl)
+        pipe.execute()
 
 
 def get_cached_recommendations(user_id, season_input):
@@ -79,152 +113,175 @@ def get_cached_recommendations(user_id, season_input):
     if not cached_data:
         return None
     try:
-        return json.loads(cached_data)
-    except json.JSONDecodeError:
+        return orjson.loads(cached_data)
+    except orjson.JSONDecodeError:
         return None
 
 
-def recommend_products_hybrid(user_id, season_input, users, products, contextual_signals, browsing_history,
+def merge_recommendations(user_id, users, device_to_products, purchased_products, product_index, index_to_product,
+                          is_new_user, popular_recommendations, mf_recommendations, cbf_recommendations,
+                          time_based_recommendations, top_n=5):
+    """Merges per-source recommendations with weighted scores and returns the top N with explanations."""
+    device_recommendations = recommend_products_device_based(user_id, users, device_to_products, purchased_products,
+                                                             top_n)
+
+    if not any([mf_recommendations, cbf_recommendations, time_based_recommendations, device_recommendations]):
+        return popular_recommendations[:top_n]
+
+    weights = NEW_USER_WEIGHTS if is_new_user else WEIGHTS
+    source_recommendations = (mf_recommendations, cbf_recommendations, popular_recommendations,
+                              time_based_recommendations, device_recommendations)
+
+    source_rows = [np.fromiter((product_index[product_id] for product_id in recommendations), dtype=np.intp,
+                               count=len(recommendations))
+                   for recommendations in source_recommendations]
+    top_rows, source_masks = merge_source_scores(source_rows, [weights[source] for source in SOURCES], top_n)
+
+    return [(product_id, EXPLANATIONS_BY_MASK[mask])
+            for product_id, mask in zip(index_to_product[top_rows].tolist(), source_masks.tolist())]
+
+
+def recommend_products_hybrid(user_id, season_input, current_day, users, category_to_products, device_to_products,
+                              contextual_signals, browsing_history,
                               purchase_history, popular_products, user_factors,
-                              item_factors, user_index, product_index, user_profiles, product_feature_vectors, top_n=5):
+                              item_factors, user_index, product_index, index_to_product, user_profiles,
+                              normalized_feature_matrix, top_n=5):
     """Combines recommendations from multiple sources and returns the top N recommendations."""
     cached_recommendations = get_cached_recommendations(user_id, season_input)
     if cached_recommendations:
         return cached_recommendations
 
     is_new_user = user_id not in browsing_history and user_id not in purchase_history
+    # Built once and shared by every source, which all exclude already purchased products
+    purchased_products = {p[0] for p in purchase_history.get(user_id, [])}
 
-    popular_recommendations = recommend_popular_trending_products(user_id, popular_products, purchase_history, top_n)
+    popular_recommendations = recommend_popular_trending_products(popular_products, purchased_products, top_n)
 
     if is_new_user:
         return [(product_id, EXPLANATION_TEMPLATES["popular"]) for product_id in popular_recommendations]
 
-    mf_recommendations = [] if is_new_user else recommend_products_mf(user_id, user_factors, item_factors, user_index,
-                                                                      product_index, purchase_history, top_n)
-    cbf_recommendations = [] if is_new_user else recommend_products_cbf(user_id, user_profiles, product_feature_vectors,
-                                                                        purchase_history, top_n)
+    mf_recommendations = recommend_products_mf(user_id, user_factors, item_factors, user_index, index_to_product,
+                                               purchased_products, top_n)
+    cbf_recommendations = recommend_products_cbf(user_id, user_profiles, user_index, normalized_feature_matrix,
+                                                 index_to_product, purchased_products, top_n)
 
-    time_based_recommendations = recommend_products_time_based(season_input, products, contextual_signals)
-    device_recommendations = recommend_products_device_based(user_id, users, products, purchase_history, top_n)
+    time_based_recommendations = recommend_products_time_based(season_input, current_day, contextual_signals,
+                                                               category_to_products)
 
-    if not any([mf_recommendations, cbf_recommendations, time_based_recommendations, device_recommendations]):
-        return popular_recommendations[:top_n]
-
-    mf_weight = float(os.getenv('MF_WEIGHT', 0.5))
-    cbf_weight = float(os.getenv('CBF_WEIGHT', 0.4))
-    popular_weight = float(os.getenv('POPULAR_WEIGHT', 0.3))
-    time_base_weight = float(os.getenv('TIME_BASE_WEIGHT', 0.2))
-    device_weight = float(os.getenv('DEVICE_WEIGHT', 0.2))
-
-    if is_new_user:
-        mf_weight = float(os.getenv('NEW_USER_MF_WEIGHT', 0.0))
-        cbf_weight = float(os.getenv('NEW_USER_CBF_WEIGHT', 0.0))
-        popular_weight = float(os.getenv('NEW_USER_POPULAR_WEIGHT', 0.5))
-        time_base_weight = float(os.getenv('NEW_USER_TIME_BASE_WEIGHT', 0.3))
-        device_weight = float(os.getenv('NEW_USER_DEVICE_WEIGHT', 0.2))
-
-    recommendation_scores = defaultdict(float)
-    recommendation_sources = defaultdict(list)
-
-    for i, product_id in enumerate(mf_recommendations):
-        recommendation_scores[product_id] += mf_weight * (1 - i / len(mf_recommendations))
-        recommendation_sources[product_id].append("mf")
-
-    for i, product_id in enumerate(cbf_recommendations):
-        recommendation_scores[product_id] += cbf_weight * (1 - i / len(cbf_recommendations))
-        recommendation_sources[product_id].append("cbf")
-
-    for i, product_id in enumerate(popular_recommendations):
-        recommendation_scores[product_id] += popular_weight * (1 - i / len(popular_recommendations))
-        recommendation_sources[product_id].append("popular")
-
-    for i, product_id in enumerate(time_based_recommendations):
-        recommendation_scores[product_id] += time_base_weight * (1 - i / len(time_based_recommendations))
-        recommendation_sources[product_id].append("time_based")
-
-    for i, product_id in enumerate(device_recommendations):
-        recommendation_scores[product_id] += device_weight * (1 - i / len(device_recommendations))
-        recommendation_sources[product_id].append("device_based")
-
-    sorted_recommendations = sorted(recommendation_scores.items(), key=lambda x: x[1], reverse=True)
-
-    top_recommendations = []
-    for product_id, _ in sorted_recommendations[:top_n]:
-        sources = recommendation_sources[product_id]
-        explanation = ", ".join([EXPLANATION_TEMPLATES[source] for source in sources])
-        top_recommendations.append((product_id, explanation))
+    top_recommendations = merge_recommendations(user_id, users, device_to_products, purchased_products, product_index,
+                                                index_to_product, is_new_user, popular_recommendations,
+                                                mf_recommendations, cbf_recommendations, time_based_recommendations,
+                                                top_n)
 
     cache_recommendations(user_id, season_input, top_recommendations)
 
     return top_recommendations
 
 
-def generate_recommendations_parallel(users, season_input, products, contextual_signals, browsing_history,
-                                      purchase_history, popular_products, user_factors, item_factors, user_index,
-                                      product_index, user_profiles, product_feature_vectors, top_n=5):
-    """Generate recommendations for all users in parallel."""
+def generate_recommendations_parallel(users, season_input, current_day, category_to_products, device_to_products,
+                                      contextual_signals, browsing_history, purchase_history, popular_products,
+                                      user_factors, item_factors, user_index, product_index, index_to_product,
+                                      user_profiles, normalized_feature_matrix, top_n=5):
+    """Generate recommendations for all users, scoring MF and CBF for the whole batch at once."""
+    # One matrix product per source scores every user against every product; rows follow user_index
+    mf_scores = user_factors @ item_factors.T
+    # Cold users have an all-zero profile with nothing to match, so only warm rows are scored
+    warm_rows = np.flatnonzero(user_profiles.any(axis=1))
+    cbf_positions = np.full(len(user_index), -1, dtype=np.intp)
+    cbf_positions[warm_rows] = np.arange(len(warm_rows))
+    cbf_scores = cosine_scores(user_profiles[warm_rows], normalized_feature_matrix)
+
+    # Trending products depend only on the day and season, so they are shared by the whole batch
+    time_based_recommendations = recommend_products_time_based(season_input, current_day, contextual_signals,
+                                                               category_to_products)
+
     recommendations = {}
-    with ProcessPoolExecutor() as executor:
-        futures = {
-            executor.submit(recommend_products_hybrid, user_id, season_input, users, products, contextual_signals,
-                            browsing_history, purchase_history, popular_products, user_factors, item_factors,
-                            user_index, product_index, user_profiles, product_feature_vectors, top_n): user_id
-            for user_id in users
-        }
-        for future in as_completed(futures):
-            user_id = futures[future]
-            try:
-                recommendations[user_id] = future.result()
-            except Exception as e:
-                logging.error(f"Error generating recommendations for user {user_id}: {e}")
+    uncached_users = []
+    for user_id in users:
+        cached_recommendations = get_cached_recommendations(user_id, season_input)
+        if cached_recommendations:
+            recommendations[user_id] = cached_recommendations
+            continue
+
+        is_new_user = user_id not in browsing_history and user_id not in purchase_history
+        purchased_products = {p[0] for p in purchase_history.get(user_id, [])}
+        popular_recommendations = recommend_popular_trending_products(popular_products, purchased_products, top_n)
+        if is_new_user:
+            recommendations[user_id] = [(product_id, EXPLANATION_TEMPLATES["popular"])
+                                        for product_id in popular_recommendations]
+            continue
+
+        user_row = user_index[user_id]
+        mf_recommendations = rank_unpurchased_products(mf_scores[user_row], index_to_product, purchased_products,
+                                                       top_n)
+        cbf_position = cbf_positions[user_row]
+        cbf_recommendations = ([] if cbf_position < 0 else
+                               rank_unpurchased_products(cbf_scores[cbf_position], index_to_product,
+                                                         purchased_products, top_n))
+        recommendations[user_id] = merge_recommendations(user_id, users, device_to_products, purchased_products,
+                                                         product_index, index_to_product, is_new_user,
+                                                         popular_recommendations, mf_recommendations,
+                                                         cbf_recommendations, time_based_recommendations, top_n)
+        uncached_users.append(user_id)
+
+    def cache_user_recommendations(user_id):
+        try:
+            cache_recommendations(user_id, season_input, recommendations[user_id])
+        except Exception as e:
+            logging.error(f"Error caching recommendations for user {user_id}: {e}")
+
+    # Caching is Redis I/O bound, so threads overlap the round trips without pickling any state
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(cache_user_recommendations, uncached_users))
     return recommendations
 
 
 def clear_cache_for_user(user_id):
     """Clears all cache entries for a specific user."""
-    cache_keys = redis_client.keys(f"recommendations:{user_id}:*")
-    for key in cache_keys:
-        redis_client.delete(key)
+    index_key = f"user_cache_index:{user_id}"
+    cache_keys = redis_client.smembers(index_key)
+    if not cache_keys:
+        # Only users without an index, i.e. cached before it existed, fall back to an incremental SCAN instead of KEYS
+        cache_keys = set(redis_client.scan_iter(match=f"recommendations:{user_id}:*", count=500))
+
+    redis_client.unlink(index_key, *cache_keys)
 
 
 def main():
     # Load data and precompute necessary structures
     users, products, browsing_history, purchase_history, contextual_signals = load_data()
     user_index, product_index = build_index(users, products)
-    all_tags, all_categories = extract_tags_and_categories(products)
-    product_feature_vectors = compute_product_feature_vectors_parallel(products, all_tags, all_categories)
-    user_profiles = compute_user_profiles_parallel(users.keys(), browsing_history, purchase_history,
-                                                   product_feature_vectors)
+    index_to_product = build_reverse_index(product_index)
+    category_to_products, device_to_products = build_product_attribute_index(products)
+    tag_index, category_index = extract_tags_and_categories(products)
+    product_feature_matrix = bulk_get_product_feature_vectors(products, product_index, tag_index, category_index)
+    # The sparse form is derived from the cached matrix; profiles then skip the zero entries of the one-hot rows
+    sparse_feature_matrix = csr_matrix(product_feature_matrix)
+    browsed_product_ids = build_history_product_ids(browsing_history)
+    purchased_product_ids = build_history_product_ids(purchase_history)
+    user_profiles = compute_user_profiles(user_index, browsed_product_ids, purchased_product_ids,
+                                          sparse_feature_matrix, product_index)
+    # Product norms are divided out once here; profiles are already unit-norm, so cosine is a plain dot product
+    normalized_feature_matrix = l2_normalize(product_feature_matrix)
     user_item_matrix = create_sparse_user_item_matrix(purchase_history, user_index, product_index)
     user_factors, item_factors = get_svd_factors(user_item_matrix)
-    popular_products = compute_product_popularity(purchase_history, products)
+    popular_products = compute_product_popularity(purchase_history, products, product_index)
 
     season_input = ["All Year", "Summer"]
+    current_day = datetime.now().strftime("%A")
+
+    recommendations = generate_recommendations_parallel(users, season_input, current_day, category_to_products,
+                                                        device_to_products, contextual_signals, browsing_history,
+                                                        purchase_history, popular_products, user_factors,
+                                                        item_factors, user_index, product_index, index_to_product,
+                                                        user_profiles, normalized_feature_matrix)
+    for user_id, user_recommendations in recommendations.items():
+        print(f"Recommendations for User {user_id} ({users[user_id]['name']}):")
+        for product_id, explanation in user_recommendations:
+            print(f"  - {products[product_id]['name']} (Category: {products[product_id]['category']})")
+            print(f"    Explanation: {explanation}")
+        print()
 
-    if 'pytest' in sys.modules:
-        for user_id in users:
-            recommendations = recommend_products_hybrid(user_id, season_input, users, products, contextual_signals,
-                                                        browsing_history, purchase_history,
-                                                        popular_products, user_factors, item_factors, user_index,
-                                                        product_index, user_profiles, product_feature_vectors)
-            print(f"Recommendations for User {user_id} ({users[user_id]['name']}):")
-            for product_id, explanation in recommendations:
-                print(f"  - {products[product_id]['name']} (Category: {products[product_id]['category']})")
-                print(f"    Explanation: {explanation}")
-            print()
-
-    else:
-        recommendations = generate_recommendations_parallel(users, season_input, products, contextual_signals,
-                                                            browsing_history,
-                                                            purchase_history, popular_products, user_factors,
-                                                            item_factors, user_index, product_index, user_profiles,
-                                                            product_feature_vectors)
-        for user_id, user_recommendations in recommendations.items():
-            print(f"Recommendations for User {user_id} ({users[user_id]['name']}):")
-            for product_id, explanation in user_recommendations:
-                print(f"  - {products[product_id]['name']} (Category: {products[product_id]['category']})")
-                print(f"    Explanation: {explanation}")
-            print()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,11 +1,12 @@
-import json
+import hashlib
+import io
 import logging
 
 import numpy as np
 import redis
 from scipy.sparse.linalg import svds
 
-from .setup import redis_client
+from .setup import binary_redis_client
 
 
 def perform_svd(user_item_matrix, k=2):
@@ -15,27 +16,42 @@ def perform_svd(user_item_matrix, k=2):
         raise ValueError("Invalid SVD dimension.")
 
     try:
-        U, sigma, Vt = svds(user_item_matrix, k=k)
-        return U @ np.diag(sigma), Vt.T
+        # float32 is ample precision for ranking and halves the memory traffic of the Lanczos iterations
+        U, sigma, Vt = svds(user_item_matrix.astype(np.float32, copy=False), k=k, solver="arpack")
+        return U * sigma, Vt.T
     except Exception as e:
         logging.error(f"SVD computation failed: {e}. Returning empty factors.")
-        return np.zeros((user_item_matrix.shape[0], k)), np.zeros((user_item_matrix.shape[1], k))
+        return (np.zeros((user_item_matrix.shape[0], k), dtype=np.float32),
+                np.zeros((user_item_matrix.shape[1], k), dtype=np.float32))
+
+
+def matrix_fingerprint(matrix):
+    """Returns a stable digest of a sparse matrix's structure and values."""
+    matrix = matrix.tocsr()
+    digest = hashlib.blake2b(digest_size=16)
+    for array in (matrix.indptr, matrix.indices, matrix.data):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
 
 
 def get_svd_factors(user_item_matrix, k=2):
     """Retrieves or computes and caches SVD factors."""
-    cache_key = f"svd_factors:{user_item_matrix.shape[0]}:{user_item_matrix.shape[1]}"
+    num_users, num_items = user_item_matrix.shape
+    # The fingerprint invalidates cached factors whenever the interactions change, not only the shape
+    cache_key = f"svd_factors_npz:{num_users}:{num_items}:{k}:{matrix_fingerprint(user_item_matrix)}"
 
     try:
-        cached_factors = redis_client.get(cache_key)
+        cached_factors = binary_redis_client.get(cache_key)
 
         if cached_factors:
-            user_factors, item_factors = json.loads(cached_factors)
-            return np.array(user_factors), np.array(item_factors)
+            # The .npz payload records shape and dtype, so the arrays load without JSON parsing or size arithmetic
+            factors = np.load(io.BytesIO(cached_factors))
+            return factors["U"], factors["V"]
 
         user_factors, item_factors = perform_svd(user_item_matrix, k)
-        redis_client.setex(cache_key, 86400,
-                           json.dumps((user_factors.tolist(), item_factors.tolist())))  # Cache for 24 hours
+        buffer = io.BytesIO()
+        np.savez(buffer, U=user_factors.astype(np.float32, copy=False), V=item_factors.astype(np.float32, copy=False))
+        binary_redis_client.setex(cache_key, 86400, buffer.getvalue())  # Cache for 24 hours
         return user_factors, item_factors
     except redis.RedisError as e:
         logging.error(f"Redis error: {e}. Falling back to computing SVD factors without caching.")
@@ -1,80 +1,97 @@
-from datetime import datetime
-
 import numpy as np
-from sklearn.neighbors import NearestNeighbors
 
 
-def recommend_products_mf(user_id, user_factors, item_factors, user_index, product_index, purchase_history, top_n=3):
+def top_n_indices(scores, n):
+    """Returns the indices of the n highest scores in descending order without sorting all scores.
+
+    Ties are broken by the lower index, including ties at the n-th score.
+    """
+    n = min(n, len(scores))
+    if n <= 0:
+        return np.empty(0, dtype=np.intp)
+    # argpartition picks tied values at the boundary in no fixed order, so every score reaching the n-th is kept
+    kth_score = np.partition(scores, len(scores) - n)[len(scores) - n]
+    candidates = np.flatnonzero(scores >= kth_score)
+    return candidates[np.lexsort((candidates, -scores[candidates]))[:n]]
+
+
+def merge_source_scores(source_rows, source_weights, top_n=5):
+    """Merges ranked product rows from several sources and returns the top N rows with their source bitmasks.
+
+    Entry i of a source with n entries scores weight * (1 - i / n); bit j of a mask is set when source j
+    recommended the product. All sources are accumulated in one pass over the candidates, not the whole catalog.
+    """
+    lengths = [len(rows) for rows in source_rows]
+    rows = np.concatenate(source_rows).astype(np.intp, copy=False)
+    entry_scores = np.concatenate([weight * (1 - np.arange(length, dtype=np.float32) / max(length, 1))
+                                   for weight, length in zip(source_weights, lengths)])
+    entry_bits = np.repeat(np.left_shift(1, np.arange(len(source_rows), dtype=np.uint8)), lengths)
+
+    candidate_rows, candidate_of_entry = np.unique(rows, return_inverse=True)
+    scores = np.bincount(candidate_of_entry, weights=entry_scores, minlength=len(candidate_rows))
+    source_masks = np.zeros(len(candidate_rows), dtype=np.uint8)
+    np.bitwise_or.at(source_masks, candidate_of_entry, entry_bits)
+
+    top = top_n_indices(scores, top_n)
+    return candidate_rows[top], source_masks[top]
+
+
+def rank_unpurchased_products(scores, index_to_product, purchased_products, top_n=3):
+    """Returns the ids of the top N scoring products that the user has not purchased yet."""
+    # Oversample by the purchase count so that filtering purchases still leaves top_n products
+    sorted_indices = top_n_indices(scores, top_n + len(purchased_products))
+    return [pid for pid in index_to_product[sorted_indices].tolist() if pid not in purchased_products][:top_n]
+
+
+def recommend_products_mf(user_id, user_factors, item_factors, user_index, index_to_product, purchased_products,
+                          top_n=3):
     """Recommends products using Matrix Factorization (SVD)."""
     if user_id not in user_index:
         return []
 
     user_vector = user_factors[user_index[user_id]]
     scores = item_factors @ user_vector
-    sorted_indices = np.argsort(scores)[::-1]
 
-    sorted_products = [list(product_index.keys())[i] for i in sorted_indices]
-    purchased_products = {p[0] for p in purchase_history.get(user_id, [])}
+    return rank_unpurchased_products(scores, index_to_product, purchased_products, top_n)
 
-    return [pid for pid in sorted_products if pid not in purchased_products][:top_n]
 
+def cosine_scores(queries, normalized_feature_matrix):
+    """Scores one unit-norm query (D,) or a batch of them (Q, D) against unit-norm product rows by cosine similarity."""
+    # With both sides normalized up front, cosine similarity is a single BLAS matrix product
+    return queries @ normalized_feature_matrix.T
 
-def recommend_products_cbf(user_id, user_profiles, product_feature_vectors, purchase_history, top_n=3):
-    """Recommends products using Content-Based Filtering."""
-    user_profile = user_profiles[user_id]
 
-    # Use NearestNeighbors for faster similarity search
-    nn = NearestNeighbors(n_neighbors=top_n, metric="cosine")
-    nn.fit(np.array(list(product_feature_vectors.values())))
-    distances, indices = nn.kneighbors([user_profile])
+def recommend_products_cbf(user_id, user_profiles, user_index, normalized_feature_matrix, index_to_product,
+                           purchased_products, top_n=3):
+    """Recommends products using Content-Based Filtering."""
+    user_profile = user_profiles[user_index[user_id]]
+    if not np.any(user_profile):
+        return []  # A cold user's empty profile is equally similar to every product
 
-    recommendations = []
-    for idx in indices[0]:
-        product_id = list(product_feature_vectors.keys())[idx]
-        if product_id not in {p[0] for p in purchase_history.get(user_id, [])}:
-            recommendations.append(product_id)
+    similarities = cosine_scores(user_profile, normalized_feature_matrix)
 
-    return recommendations[:top_n]
+    return rank_unpurchased_products(similarities, index_to_product, purchased_products, top_n)
 
 
-def recommend_popular_trending_products(user_id, popular_products, purchase_history, top_n=3):
+def recommend_popular_trending_products(popular_products, purchased_products, top_n=3):
     """Recommends top trending products."""
-    purchased_products = {p[0] for p in purchase_history.get(user_id, [])}
     return [pid for pid, _ in popular_products if pid not in purchased_products][:top_n]
 
 
-def recommend_products_time_based(season_input, products, contextual_signals):
+def recommend_products_time_based(season_input, current_day, contextual_signals, category_to_products):
     """Recommends products based on time of day/week trends."""
-    current_day = datetime.now().strftime("%A")
-
-    trending_categories = set()
+    trending_products = []
     for category, signals in contextual_signals.items():
         if current_day in signals["peak_days"] and signals["season"] in season_input:
-            trending_categories.add(category)
-
-    trending_products = []
-    for product_id, product in products.items():
-        if product["category"] in trending_categories:
-            trending_products.append(product_id)
+            trending_products.extend(category_to_products.get(category, []))
 
     return trending_products
 
 
-def recommend_products_device_based(user_id, users, products, purchase_history, top_n=3):
+def recommend_products_device_based(user_id, users, device_to_products, purchased_products, top_n=3):
     """Recommends products based on device type."""
     if user_id not in users:
         return []
 
-    device_type = users[user_id]["device"]
-
-    device_recommendations = []
-    for product_id, product in products.items():
-        if device_type in product["device_suitability"]:
-            device_recommendations.append(product_id)
-
-    if user_id in purchase_history:
-        purchased_products = set([product_id for product_id, _, _ in purchase_history[user_id]])
-        device_recommendations = [product_id for product_id in device_recommendations if
-                                  product_id not in purchased_products]
-
-    return device_recommendations[:top_n]
+    device_recommendations = device_to_products.get(users[user_id]["device"], [])
+    return [product_id for product_id in device_recommendations if product_id not in purchased_products][:top_n]
@@ -5,12 +5,26 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-redis_client = redis.Redis(
-    host=os.getenv("REDIS_HOST", "localhost"),
-    port=int(os.getenv("REDIS_PORT", 6379)),
-    db=int(os.getenv("REDIS_DB", 0)),
+redis_connection_kwargs = {
+    "host": os.getenv("REDIS_HOST", "localhost"),
+    "port": int(os.getenv("REDIS_PORT", 6379)),
+    "db": int(os.getenv("REDIS_DB", 0)),
+    "max_connections": int(os.getenv("REDIS_MAX_CONNECTIONS", 64)),
+}
+
+# Connection pools are created once and shared module-wide. Response decoding is a pool-level setting,
+# so the text and binary clients each get their own pool. Blocking pools make callers wait for a free connection
+# once max_connections are in use, instead of failing with "Too many connections".
+redis_pool = redis.BlockingConnectionPool(
+    **redis_connection_kwargs,
     decode_responses=os.getenv("REDIS_DECODE_RESPONSES", "True").lower() == "true"
 )
+binary_redis_pool = redis.BlockingConnectionPool(**redis_connection_kwargs, decode_responses=False)
+
+redis_client = redis.Redis(connection_pool=redis_pool)
+
+# Client for raw NumPy array payloads, which must not be decoded as text
+binary_redis_client = redis.Redis(connection_pool=binary_redis_pool)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
\ No newline at end of file
@@ -1,36 +1,110 @@
 import json
+from datetime import datetime
 
 import numpy as np
 import pytest
 from unittest.mock import patch
 
-from .data_loading import load_data, build_index, extract_tags_and_categories
-from .feature_engineering import create_product_feature_vector
-from .main import recommend_products_hybrid, create_sparse_user_item_matrix, compute_product_popularity
-from .matrix_factorization import get_svd_factors
-from .user_profiles import compute_user_profiles_parallel
+from .data_loading import load_data, build_index, build_reverse_index, build_product_attribute_index, \
+    build_index_lookup, build_history_product_ids, extract_tags_and_categories
+from .feature_engineering import create_product_feature_vector, build_product_feature_matrix, \
+    bulk_get_product_feature_vectors, l2_normalize, build_sparse_product_feature_matrix, vocabulary_fingerprint
+from .main import recommend_products_hybrid, create_sparse_user_item_matrix, compute_product_popularity, \
+    generate_recommendations_parallel, clear_cache_for_user, cache_recommendations, get_cached_recommendations
+from .setup import redis_client
+from .matrix_factorization import get_svd_factors, perform_svd, matrix_fingerprint
+from .recommendation_algorithms import top_n_indices, recommend_products_cbf, recommend_products_time_based, \
+    merge_source_scores, cosine_scores
+from .user_profiles import compute_user_profiles, _user_profile_cache_key
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def data():
     """Fixture to load data."""
     return load_data()
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def indices(data):
     """Fixture to build user and product indices."""
     users, products, _, _, _ = data
     return build_index(users, products)
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def tags_and_categories(data):
     """Fixture to extract tags and categories."""
     _, products, _, _, _ = data
     return extract_tags_and_categories(products)
 
 
+@pytest.fixture(scope="session")
+def index_to_product(indices):
+    """Fixture to map product rows back to product IDs."""
+    _, product_index = indices
+    return build_reverse_index(product_index)
+
+
+@pytest.fixture(scope="session")
+def product_attributes(data):
+    """Fixture to look up products by category and by supported device."""
+    _, products, _, _, _ = data
+    return build_product_attribute_index(products)
+
+
+@pytest.fixture(scope="session")
+def product_feature_matrix(data, indices, tags_and_categories):
+    """Fixture to build the product feature matrix, read-only since it is shared by the whole session."""
+    _, products, _, _, _ = data
+    _, product_index = indices
+    tag_index, category_index = tags_and_categories
+    product_feature_matrix = build_product_feature_matrix(products, product_index, tag_index, category_index)
+    product_feature_matrix.setflags(write=False)
+    return product_feature_matrix
+
+
+@pytest.fixture(scope="session")
+def normalized_feature_matrix(product_feature_matrix):
+    """Fixture for the unit-norm product feature matrix used for content-based scoring."""
+    normalized_feature_matrix = l2_normalize(product_feature_matrix)
+    normalized_feature_matrix.setflags(write=False)
+    return normalized_feature_matrix
+
+
+@pytest.fixture(scope="session")
+def user_profiles(data, indices, product_feature_matrix):
+    """Fixture to compute the profile matrix of all users, read-only since it is shared by the whole session."""
+    _, _, browsing_history, purchase_history, _ = data
+    user_index, product_index = indices
+    user_profiles = compute_user_profiles(user_index, build_history_product_ids(browsing_history),
+                                          build_history_product_ids(purchase_history), product_feature_matrix,
+                                          product_index)
+    user_profiles.setflags(write=False)
+    return user_profiles
+
+
+@pytest.fixture(scope="session")
+def svd_factors(data, indices):
+    """Fixture to compute the user and item SVD factors."""
+    _, _, _, purchase_history, _ = data
+    user_index, product_index = indices
+    return get_svd_factors(create_sparse_user_item_matrix(purchase_history, user_index, product_index))
+
+
+@pytest.fixture(scope="session")
+def popular_products(data, indices):
+    """Fixture to rank products by popularity."""
+    _, products, _, purchase_history, _ = data
+    _, product_index = indices
+    return compute_product_popularity(purchase_history, products, product_index)
+
+
+@pytest.fixture
+def current_day():
+    """Fixture for the day of the week recommendations are generated on."""
+    return datetime.now().strftime("%A")
+
+
 @pytest.fixture
 def example_user_id():
     """Fixture for an example user ID."""
@@ -70,25 +144,379 @@ def test_build_index(indices):
     user_index, product_index = indices
     assert len(user_index) == 5  # 5 users in the sample data
     assert len(product_index) == 5  # 5 products in the sample data
+    index_to_product = build_reverse_index(product_index)
+    assert all(index_to_product[idx] == product_id for product_id, idx in product_index.items())
+
+
+def test_build_index_lookup(indices):
+    """Test if the lookup table maps integer ids to their index positions and rejects unsuitable ids."""
+    _, product_index = indices
+    lookup = build_index_lookup(product_index)
+    assert all(lookup[product_id] == idx for product_id, idx in product_index.items())
+    assert (lookup >= 0).sum() == len(product_index)  # Ids missing from the index map to -1
+    assert build_index_lookup(product_index, max_id=100) is None
+    assert build_index_lookup({"a": 0}) is None
+
+
+def test_build_history_product_ids(data):
+    """Test if history product id arrays keep every entry of each non-empty history in order, with integer ids."""
+    _, _, browsing_history, purchase_history, _ = data
+    for history in (browsing_history, purchase_history):
+        history_product_ids = build_history_product_ids(history)
+        assert history_product_ids.keys() == {user_id for user_id, entries in history.items() if entries}
+        for user_id, product_ids in history_product_ids.items():
+            assert product_ids.dtype.kind == "i"
+            assert product_ids.tolist() == [entry[0] for entry in history[user_id]]
+    assert build_history_product_ids({1: []}) == {}
+
+
+def test_recommend_products_time_based(data):
+    """Test if only products in categories peaking on the given day and season are recommended."""
+    _, products, _, _, contextual_signals = data
+    category_to_products, _ = build_product_attribute_index(products)
+    assert recommend_products_time_based(["Summer"], "Monday", contextual_signals, category_to_products) == [103]
+    assert recommend_products_time_based(["Summer"], "Sunday", contextual_signals, category_to_products) == []
+
+
+def test_build_product_attribute_index(data):
+    """Test if products are indexed under their category and every suitable device."""
+    _, products, _, _, _ = data
+    category_to_products, device_to_products = build_product_attribute_index(products)
+    for product_id, product in products.items():
+        assert product_id in category_to_products[product["category"]]
+        for device in product["device_suitability"]:
+            assert product_id in device_to_products[device]
+    assert sum(map(len, category_to_products.values())) == len(products)
 
 
 def test_extract_tags_and_categories(tags_and_categories):
     """Test if tags and categories are extracted correctly."""
-    all_tags, all_categories = tags_and_categories
-    assert isinstance(all_tags, list)
-    assert isinstance(all_categories, list)
-    assert len(all_tags) > 0
-    assert len(all_categories) > 0
+    tag_index, category_index = tags_and_categories
+    assert isinstance(tag_index, dict)
+    assert isinstance(category_index, dict)
+    assert sorted(tag_index.values()) == list(range(len(tag_index)))
+    assert sorted(category_index.values()) == list(range(len(category_index)))
 
 
 def test_create_product_feature_vector(data, tags_and_categories):
     """Test if product feature vectors are created correctly."""
     _, products, _, _, _ = data
-    all_tags, all_categories = tags_and_categories
+    tag_index, category_index = tags_and_categories
     product = products[101]  # Example product
-    feature_vector = create_product_feature_vector(product, all_tags, all_categories)
+    feature_vector = create_product_feature_vector(product, tag_index, category_index)
     assert isinstance(feature_vector, np.ndarray)
-    assert len(feature_vector) == len(all_tags) + len(all_categories)
+    assert len(feature_vector) == len(tag_index) + len(category_index)
+    assert feature_vector.dtype == np.float32
+    assert feature_vector.sum() == len(product["tags"]) + 1
+
+
+def test_build_product_feature_matrix(data, indices, tags_and_categories):
+    """Test if the product feature matrix rows match the per-product feature vectors."""
+    _, products, _, _, _ = data
+    _, product_index = indices
+    tag_index, category_index = tags_and_categories
+    feature_matrix = build_product_feature_matrix(products, product_index, tag_index, category_index)
+    assert feature_matrix.shape == (len(products), len(tag_index) + len(category_index))
+    for product_id, product in products.items():
+        expected = create_product_feature_vector(product, tag_index, category_index)
+        np.testing.assert_array_equal(feature_matrix[product_index[product_id]], expected)
+
+    product = {"tags": ["a", "a"], "category": "c"}
+    feature_matrix = build_product_feature_matrix({1: product}, {1: 0}, {"a": 0}, {"c": 0})
+    np.testing.assert_array_equal(feature_matrix, [create_product_feature_vector(product, {"a": 0}, {"c": 0})])
+
+
+@pytest.mark.parametrize("n", [0, 1, 3, 10])
+def test_top_n_indices(n):
+    """Test if top-n selection matches a full descending sort."""
+    scores = np.array([0.3, 0.9, 0.1, 0.7, 0.5])
+    assert top_n_indices(scores, n).tolist() == np.argsort(-scores)[:n].tolist()
+
+
+def test_top_n_indices_breaks_ties_by_lower_index():
+    """Test if ties, including ties at the n-th score, resolve to the lower indices."""
+    scores = np.array([0.5, 0.9, 0.5, 0.5, 0.1, 0.5] * 50)
+    assert top_n_indices(scores, 3).tolist() == [1, 7, 13]
+    assert top_n_indices(scores, 53).tolist() == np.argsort(-scores, kind="stable")[:53].tolist()
+
+
+def test_merge_source_scores():
+    """Test if source scores are rank-decayed, summed per product, and tagged with source bits."""
+    source_rows = [np.array([2, 0]), np.array([], dtype=np.intp), np.array([0, 3, 1])]
+    top_rows, source_masks = merge_source_scores(source_rows, [0.5, 0.4, 0.3], top_n=3)
+    # Row 0 scores 0.25 + 0.3, row 2 scores 0.5, row 3 scores 0.2
+    assert top_rows.tolist() == [0, 2, 3]
+    assert source_masks.tolist() == [0b101, 0b001, 0b100]
+
+
+def test_compute_product_popularity(data, indices):
+    """Test if only purchased products are ranked, normalized to a maximum popularity of 1."""
+    _, products, _, purchase_history, _ = data
+    _, product_index = indices
+    popular_products = compute_product_popularity(purchase_history, products, product_index)
+    assert [product_id for product_id, _ in popular_products] == [101, 103, 105]  # 101 was purchased twice
+    assert popular_products[0][1] == pytest.approx(1.0)
+    scores = [score for _, score in popular_products]
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_compute_product_popularity_with_string_ids():
+    """Test if product popularity also works for non-integer product ids."""
+    products = {"a": {"rating": 4.0}, "b": {"rating": 5.0}, "c": {"rating": 3.0}}
+    purchase_history = {1: [("a", 1, "2025-03-01 10:00:00"), ("a", 1, "2025-03-02 10:00:00")],
+                        2: [("c", 1, "2025-03-03 10:00:00")]}
+    popular_products = compute_product_popularity(purchase_history, products, {"a": 0, "b": 1, "c": 2})
+    assert [product_id for product_id, _ in popular_products] == ["a", "c"]
+
+
+def test_clear_cache_for_user(new_user_id):
+    """Test if indexed cache entries of a user are cleared without scanning the keyspace."""
+    cache_recommendations(new_user_id, ["Summer"], [(101, "Recommended.")])
+    cache_recommendations(new_user_id, ["Winter"], [(102, "Recommended.")])
+    assert get_cached_recommendations(new_user_id, ["Summer"]) == [[101, "Recommended."]]
+
+    with patch("recommendation_system.main.redis_client.scan_iter") as mock_scan_iter:
+        clear_cache_for_user(new_user_id)
+    mock_scan_iter.assert_not_called()
+    assert get_cached_recommendations(new_user_id, ["Summer"]) is None
+    assert get_cached_recommendations(new_user_id, ["Winter"]) is None
+    assert not redis_client.exists(f"user_cache_index:{new_user_id}")
+
+
+def test_clear_cache_for_user_without_index(new_user_id):
+    """Test if cache entries written before the user cache index existed are still cleared."""
+    redis_client.setex(f"recommendations:{new_user_id}:Legacy", 3600, "[]")
+    clear_cache_for_user(new_user_id)
+    assert not redis_client.exists(f"recommendations:{new_user_id}:Legacy")
+
+
+def test_create_sparse_user_item_matrix(data, indices):
+    """Test if the user-item matrix has one float32 entry per purchase."""
+    _, _, _, purchase_history, _ = data
+    user_index, product_index = indices
+    user_item_matrix = create_sparse_user_item_matrix(purchase_history, user_index, product_index)
+    assert user_item_matrix.shape == (len(user_index), len(product_index))
+    assert user_item_matrix.dtype == np.float32
+    assert user_item_matrix.nnz == sum(len(purchases) for purchases in purchase_history.values())
+    assert user_item_matrix[user_index[2], product_index[105]] == 1
+
+
+def test_perform_svd(data, indices):
+    """Test if SVD factors are float32 and reconstruct the user-item matrix better than zero factors."""
+    _, _, _, purchase_history, _ = data
+    user_index, product_index = indices
+    user_item_matrix = create_sparse_user_item_matrix(purchase_history, user_index, product_index)
+    user_factors, item_factors = perform_svd(user_item_matrix, k=2)
+    assert user_factors.shape == (len(user_index), 2)
+    assert item_factors.shape == (len(product_index), 2)
+    assert user_factors.dtype == item_factors.dtype == np.float32
+    dense = user_item_matrix.toarray()
+    assert np.linalg.norm(dense - user_factors @ item_factors.T) < np.linalg.norm(dense)
+
+
+def test_get_svd_factors_round_trips_through_cache(data, indices):
+    """Test if cached SVD factors load back with the same shape, dtype, and values."""
+    _, _, _, purchase_history, _ = data
+    user_index, product_index = indices
+    user_item_matrix = create_sparse_user_item_matrix(purchase_history, user_index, product_index)
+    user_factors, item_factors = get_svd_factors(user_item_matrix)
+    cached_user_factors, cached_item_factors = get_svd_factors(user_item_matrix)
+    assert cached_user_factors.dtype == cached_item_factors.dtype == np.float32
+    np.testing.assert_array_equal(cached_user_factors, user_factors)
+    np.testing.assert_array_equal(cached_item_factors, item_factors)
+
+
+def test_matrix_fingerprint_changes_with_interactions(data, indices):
+    """Test if the SVD cache fingerprint depends on the interactions, not just the matrix shape."""
+    _, _, _, purchase_history, _ = data
+    user_index, product_index = indices
+    user_item_matrix = create_sparse_user_item_matrix(purchase_history, user_index, product_index)
+    changed_history = {**purchase_history, 1: [(102, 1, "2025-03-04 10:00:00")]}
+    changed_matrix = create_sparse_user_item_matrix(changed_history, user_index, product_index)
+    assert matrix_fingerprint(user_item_matrix) == matrix_fingerprint(user_item_matrix.copy())
+    assert matrix_fingerprint(user_item_matrix) != matrix_fingerprint(changed_matrix)
+
+
+def test_bulk_get_product_feature_vectors(data, indices, tags_and_categories):
+    """Test if bulk-fetched feature vectors match the computed matrix on both cache misses and hits."""
+    _, products, _, _, _ = data
+    _, product_index = indices
+    tag_index, category_index = tags_and_categories
+    expected = build_product_feature_matrix(products, product_index, tag_index, category_index)
+    for _ in range(2):
+        feature_matrix = bulk_get_product_feature_vectors(products, product_index, tag_index, category_index)
+        np.testing.assert_array_equal(feature_matrix, expected)
+
+
+def test_vocabulary_fingerprint_changes_with_layout(tags_and_categories):
+    """Test if the feature cache fingerprint depends on the tag order, not just the vocabulary size."""
+    tag_index, category_index = tags_and_categories
+    tags = list(tag_index)
+    swapped_tag_index = {**tag_index, tags[0]: tag_index[tags[1]], tags[1]: tag_index[tags[0]]}
+    assert vocabulary_fingerprint(tag_index, category_index) == vocabulary_fingerprint(dict(tag_index),
+                                                                                        category_index)
+    assert vocabulary_fingerprint(tag_index, category_index) != vocabulary_fingerprint(swapped_tag_index,
+                                                                                        category_index)
+
+
+def _clear_cached_profiles(user_ids):
+    """Deletes the cached profiles of the given users, for any feature matrix or history, so they are recomputed."""
+    for user_id in user_ids:
+        cache_keys = list(redis_client.scan_iter(match=_user_profile_cache_key(user_id, "*", "*")))
+        if cache_keys:
+            redis_client.delete(*cache_keys)
+
+
+def test_compute_user_profiles(data, indices, tags_and_categories, product_feature_matrix):
+    """Test if a user profile is the unit-norm mean feature vector of the distinct products the user interacted with."""
+    _, products, browsing_history, purchase_history, _ = data
+    user_index, product_index = indices
+    tag_index, category_index = tags_and_categories
+    browsed_product_ids = build_history_product_ids(browsing_history)
+    purchased_product_ids = build_history_product_ids(purchase_history)
+    sparse_feature_matrix = build_sparse_product_feature_matrix(products, product_index, tag_index, category_index)
+
+    for feature_matrix in (product_feature_matrix, sparse_feature_matrix):
+        _clear_cached_profiles(user_index)
+        user_profiles = compute_user_profiles(user_index, browsed_product_ids, purchased_product_ids, feature_matrix,
+                                              product_index)
+        assert user_profiles.shape == (len(user_index), product_feature_matrix.shape[1])
+        assert user_profiles.dtype == np.float32
+        for user_id, row in user_index.items():
+            interacted_products = ({product_id for product_id, _ in browsing_history.get(user_id, [])}
+                                   | {product_id for product_id, _, _ in purchase_history.get(user_id, [])})
+            expected_profile = l2_normalize(product_feature_matrix[[product_index[product_id]
+                                                                    for product_id in interacted_products]].sum(axis=0))
+            np.testing.assert_allclose(user_profiles[row], expected_profile, rtol=1e-6)
+
+    _clear_cached_profiles([1])
+    user_profiles = compute_user_profiles({1: 0}, {}, {}, product_feature_matrix, product_index)
+    assert not user_profiles.any()  # No interactions
+
+
+def test_compute_user_profiles_uses_cache(data, indices, product_feature_matrix):
+    """Test if cached float16 user profiles match the freshly computed ones to half precision, small entries too."""
+    _, _, browsing_history, purchase_history, _ = data
+    user_index, product_index = indices
+    browsed_product_ids = build_history_product_ids(browsing_history)
+    purchased_product_ids = build_history_product_ids(purchase_history)
+    _clear_cached_profiles(user_index)
+    user_profiles = compute_user_profiles(user_index, browsed_product_ids, purchased_product_ids,
+                                          product_feature_matrix, product_index)
+    cached_user_profiles = compute_user_profiles(user_index, browsed_product_ids, purchased_product_ids,
+                                                 product_feature_matrix, product_index)
+    assert cached_user_profiles.dtype == np.float32
+    np.testing.assert_allclose(cached_user_profiles, user_profiles, rtol=1e-3)
+
+    # A broad history spreads the profile thinly; its long-tail components must survive the cache round trip
+    wide_user_index = {1: 0}
+    _clear_cached_profiles(wide_user_index)
+    wide_browsed_product_ids = {1: np.array(list(product_index), dtype=np.int64)}
+    wide_profiles = compute_user_profiles(wide_user_index, wide_browsed_product_ids, {}, product_feature_matrix,
+                                          product_index)
+    cached_wide_profiles = compute_user_profiles(wide_user_index, wide_browsed_product_ids, {},
+                                                 product_feature_matrix, product_index)
+    np.testing.assert_allclose(cached_wide_profiles, wide_profiles, rtol=1e-3)
+    assert np.count_nonzero(cached_wide_profiles) == np.count_nonzero(wide_profiles)
+
+
+def test_compute_user_profiles_with_changed_features(data, indices, product_feature_matrix):
+    """Test if profiles cached for one feature layout are not served for an extended or reordered one."""
+    _, _, browsing_history, purchase_history, _ = data
+    user_index, product_index = indices
+    browsed_product_ids = build_history_product_ids(browsing_history)
+    purchased_product_ids = build_history_product_ids(purchase_history)
+    _clear_cached_profiles(user_index)
+    user_profiles = compute_user_profiles(user_index, browsed_product_ids, purchased_product_ids,
+                                          product_feature_matrix, product_index)
+
+    extended_feature_matrix = np.hstack([product_feature_matrix, np.zeros((len(product_index), 1), dtype=np.float32)])
+    extended_profiles = compute_user_profiles(user_index, browsed_product_ids, purchased_product_ids,
+                                              extended_feature_matrix, product_index)
+    np.testing.assert_allclose(extended_profiles[:, :-1], user_profiles, rtol=1e-3)
+
+    reordered_profiles = compute_user_profiles(user_index, browsed_product_ids, purchased_product_ids,
+                                               product_feature_matrix[:, ::-1], product_index)
+    np.testing.assert_allclose(reordered_profiles, user_profiles[:, ::-1], rtol=1e-3)
+
+
+def test_compute_user_profiles_with_changed_history(data, indices, product_feature_matrix):
+    """Test if a cached profile is recomputed as soon as the user's history changes."""
+    _, _, browsing_history, purchase_history, _ = data
+    user_index, product_index = indices
+    browsed_product_ids = build_history_product_ids(browsing_history)
+    purchased_product_ids = build_history_product_ids(purchase_history)
+    _clear_cached_profiles(user_index)
+    compute_user_profiles(user_index, browsed_product_ids, purchased_product_ids, product_feature_matrix,
+                          product_index)
+
+    new_product_id = next(product_id for product_id in product_index
+                          if product_id not in browsed_product_ids.get(1, []))
+    browsed_product_ids = {**browsed_product_ids,
+                           1: np.append(browsed_product_ids.get(1, np.empty(0, dtype=np.int64)), new_product_id)}
+    user_profiles = compute_user_profiles(user_index, browsed_product_ids, purchased_product_ids,
+                                          product_feature_matrix, product_index)
+    interacted_rows = [product_index[product_id]
+                       for product_id in set(browsed_product_ids[1]) | set(purchased_product_ids.get(1, []))]
+    expected_profile = l2_normalize(product_feature_matrix[interacted_rows].sum(axis=0))
+    np.testing.assert_allclose(user_profiles[user_index[1]], expected_profile, rtol=1e-6)
+
+
+def test_compute_user_profiles_skips_failed_users(data, indices, product_feature_matrix):
+    """Test if a user whose history cannot be profiled keeps an empty profile without affecting the others."""
+    _, _, browsing_history, purchase_history, _ = data
+    user_index, product_index = indices
+    browsed_product_ids = {**build_history_product_ids(browsing_history), 2: np.array([999], dtype=np.int64)}
+    purchased_product_ids = build_history_product_ids(purchase_history)
+    _clear_cached_profiles([2])
+
+    user_profiles = compute_user_profiles(user_index, browsed_product_ids, purchased_product_ids,
+                                          product_feature_matrix, product_index)
+    assert not user_profiles[user_index[2]].any()  # Unknown product 999
+    assert user_profiles[user_index[1]].any()
+
+
+def test_compute_user_profiles_with_string_ids(product_feature_matrix):
+    """Test if profiles are built through the dict fallback when product ids are not integers."""
+    product_index = {f"p{row}": row for row in range(len(product_feature_matrix))}
+    browsing_history = {"u1": [("p0", "2025-03-01 10:00:00"), ("p2", "2025-03-01 11:00:00")], "u2": []}
+    browsed_product_ids = build_history_product_ids(browsing_history)
+    assert browsed_product_ids["u1"].dtype.kind == "U"
+    _clear_cached_profiles(["u1", "u2"])
+
+    user_profiles = compute_user_profiles({"u1": 0, "u2": 1}, browsed_product_ids, {}, product_feature_matrix,
+                                          product_index)
+    np.testing.assert_allclose(user_profiles[0], l2_normalize(product_feature_matrix[0] + product_feature_matrix[2]),
+                               rtol=1e-6)
+    assert not user_profiles[1].any()  # Empty history
+
+
+def test_cosine_scores(product_feature_matrix, normalized_feature_matrix):
+    """Test if cosine scores of unit-norm queries match the explicit cosine similarity, singly and in a batch."""
+    queries = l2_normalize(product_feature_matrix[:2] + 0.5 * product_feature_matrix[2:4])
+    norms = np.linalg.norm(product_feature_matrix, axis=1)
+    expected_scores = queries @ product_feature_matrix.T / norms
+    np.testing.assert_allclose(cosine_scores(queries, normalized_feature_matrix), expected_scores, rtol=1e-6)
+    np.testing.assert_allclose(cosine_scores(queries[0], normalized_feature_matrix), expected_scores[0], rtol=1e-6)
+
+
+def test_recommend_products_cbf(indices, product_feature_matrix, normalized_feature_matrix):
+    """Test if content-based recommendations rank the most similar unpurchased products first."""
+    _, product_index = indices
+    profile_index = {1: 0, 2: 1}
+    user_profiles = l2_normalize(np.stack([
+        product_feature_matrix[product_index[103]] + 0.5 * product_feature_matrix[product_index[101]],
+        np.zeros(product_feature_matrix.shape[1], dtype=np.float32),
+    ]))
+
+    recommendations = recommend_products_cbf(1, user_profiles, profile_index, normalized_feature_matrix,
+                                             build_reverse_index(product_index), {101}, top_n=3)
+    assert recommendations[0] == 103
+    assert 101 not in recommendations  # Already purchased
+    assert len(recommendations) == 3
+
+    assert recommend_products_cbf(2, user_profiles, profile_index, normalized_feature_matrix,
+                                  build_reverse_index(product_index), set()) == []  # Cold user
 
 
 @pytest.mark.parametrize("user_id, season_input", [
@@ -96,23 +524,19 @@ def test_create_product_feature_vector(data, tags_and_categories):
     (999, ["All Year", "Summer"]),  # New user with valid season input
     (1, []),  # Existing user with empty season input
 ])
-def test_recommend_products_hybrid(data, user_id, season_input):
+def test_recommend_products_hybrid(data, indices, index_to_product, product_attributes, user_profiles,
+                                   normalized_feature_matrix, svd_factors, popular_products, current_day, user_id,
+                                   season_input):
     """Test if hybrid recommendations are generated correctly for different scenarios."""
     users, products, browsing_history, purchase_history, contextual_signals = data
-    user_index, product_index = build_index(users, products)
-    all_tags, all_categories = extract_tags_and_categories(products)
-    product_feature_vectors = {product_id: create_product_feature_vector(product, all_tags, all_categories)
-                               for product_id, product in products.items()}
-    user_profiles = compute_user_profiles_parallel(users.keys(), browsing_history, purchase_history,
-                                                   product_feature_vectors)
-    user_item_matrix = create_sparse_user_item_matrix(purchase_history, user_index, product_index)
-    user_factors, item_factors = get_svd_factors(user_item_matrix)
-    popular_products = compute_product_popularity(purchase_history, products)
+    user_index, product_index = indices
+    category_to_products, device_to_products = product_attributes
+    user_factors, item_factors = svd_factors
 
     recommendations = recommend_products_hybrid(
-        user_id, season_input, users, products, contextual_signals, browsing_history,
-        purchase_history, popular_products, user_factors, item_factors, user_index,
-        product_index, user_profiles, product_feature_vectors
+        user_id, season_input, current_day, users, category_to_products, device_to_products, contextual_signals,
+        browsing_history, purchase_history, popular_products, user_factors, item_factors, user_index, product_index,
+        index_to_product, user_profiles, normalized_feature_matrix
     )
     assert isinstance(recommendations, list)
     assert len(recommendations) <= 5  # Check if top_n=5 is respected
@@ -121,23 +545,19 @@ def test_recommend_products_hybrid(data, user_id, season_input):
         assert isinstance(explanation, str)
 
 
-def test_recommend_products_hybrid_new_user(data, new_user_id, example_season_input):
+def test_recommend_products_hybrid_new_user(data, indices, index_to_product, product_attributes, user_profiles,
+                                            normalized_feature_matrix, svd_factors, popular_products, current_day,
+                                            new_user_id, example_season_input):
     """Test hybrid recommendations for a new user."""
     users, products, browsing_history, purchase_history, contextual_signals = data
-    user_index, product_index = build_index(users, products)
-    all_tags, all_categories = extract_tags_and_categories(products)
-    product_feature_vectors = {product_id: create_product_feature_vector(product, all_tags, all_categories)
-                               for product_id, product in products.items()}
-    user_profiles = compute_user_profiles_parallel(users.keys(), browsing_history, purchase_history,
-                                                   product_feature_vectors)
-    user_item_matrix = create_sparse_user_item_matrix(purchase_history, user_index, product_index)
-    user_factors, item_factors = get_svd_factors(user_item_matrix)
-    popular_products = compute_product_popularity(purchase_history, products)
+    user_index, product_index = indices
+    category_to_products, device_to_products = product_attributes
+    user_factors, item_factors = svd_factors
 
     recommendations = recommend_products_hybrid(
-        new_user_id, example_season_input, users, products, contextual_signals, browsing_history,
-        purchase_history, popular_products, user_factors, item_factors, user_index,
-        product_index, user_profiles, product_feature_vectors
+        new_user_id, example_season_input, current_day, users, category_to_products, device_to_products,
+        contextual_signals, browsing_history, purchase_history, popular_products, user_factors, item_factors,
+        user_index, product_index, index_to_product, user_profiles, normalized_feature_matrix
     )
     assert isinstance(recommendations, list)
     assert len(recommendations) <= 5
@@ -145,59 +565,52 @@ def test_recommend_products_hybrid_new_user(data, new_user_id, example_season_in
 
 def test_create_product_feature_vector_invalid_product(tags_and_categories):
     """Test handling of invalid product data."""
-    all_tags, all_categories = tags_and_categories
+    tag_index, category_index = tags_and_categories
     invalid_product = {"name": "Invalid Product", "tags": [], "category": "Invalid"}
     with pytest.raises(ValueError):
-        create_product_feature_vector(invalid_product, all_tags, all_categories)
+        create_product_feature_vector(invalid_product, tag_index, category_index)
 
 
 def test_create_product_feature_vector_missing_category(tags_and_categories):
     """Test handling of missing category in product data."""
-    all_tags, all_categories = tags_and_categories
+    tag_index, category_index = tags_and_categories
     invalid_product = {"name": "Invalid Product", "tags": ["audio"], "category": "NonExistentCategory"}
     with pytest.raises(ValueError):
-        create_product_feature_vector(invalid_product, all_tags, all_categories)
+        create_product_feature_vector(invalid_product, tag_index, category_index)
 
 
-def test_recommend_products_hybrid_no_data(data, example_user_id, empty_season_input):
+def test_recommend_products_hybrid_no_data(data, indices, index_to_product, product_attributes, user_profiles,
+                                           normalized_feature_matrix, svd_factors, popular_products, current_day,
+                                           example_user_id, empty_season_input):
     """Test hybrid recommendations with no data."""
     users, products, browsing_history, purchase_history, contextual_signals = data
-    user_index, product_index = build_index(users, products)
-    all_tags, all_categories = extract_tags_and_categories(products)
-    product_feature_vectors = {product_id: create_product_feature_vector(product, all_tags, all_categories)
-                               for product_id, product in products.items()}
-    user_profiles = compute_user_profiles_parallel(users.keys(), browsing_history, purchase_history,
-                                                   product_feature_vectors)
-    user_item_matrix = create_sparse_user_item_matrix(purchase_history, user_index, product_index)
-    user_factors, item_factors = get_svd_factors(user_item_matrix)
-    popular_products = compute_product_popularity(purchase_history, products)
+    user_index, product_index = indices
+    category_to_products, device_to_products = product_attributes
+    user_factors, item_factors = svd_factors
 
     recommendations = recommend_products_hybrid(
-        example_user_id, empty_season_input, users, products, contextual_signals, browsing_history,
-        purchase_history, popular_products, user_factors, item_factors, user_index,
-        product_index, user_profiles, product_feature_vectors
+        example_user_id, empty_season_input, current_day, users, category_to_products, device_to_products,
+        contextual_signals, browsing_history, purchase_history, popular_products, user_factors, item_factors,
+        user_index, product_index, index_to_product, user_profiles, normalized_feature_matrix
     )
     assert isinstance(recommendations, list)
     assert len(recommendations) <= 5
 
 
-def test_recommend_products_hybrid_specific_recommendations(data, example_user_id, example_season_input):
+def test_recommend_products_hybrid_specific_recommendations(data, indices, index_to_product, product_attributes,
+                                                           user_profiles, normalized_feature_matrix, svd_factors,
+                                                           popular_products, current_day, example_user_id,
+                                                           example_season_input):
     """Test if specific recommendations are generated for a user."""
     users, products, browsing_history, purchase_history, contextual_signals = data
-    user_index, product_index = build_index(users, products)
-    all_tags, all_categories = extract_tags_and_categories(products)
-    product_feature_vectors = {product_id: create_product_feature_vector(product, all_tags, all_categories)
-                               for product_id, product in products.items()}
-    user_profiles = compute_user_profiles_parallel(users.keys(), browsing_history, purchase_history,
-                                                   product_feature_vectors)
-    user_item_matrix = create_sparse_user_item_matrix(purchase_history, user_index, product_index)
-    user_factors, item_factors = get_svd_factors(user_item_matrix)
-    popular_products = compute_product_popularity(purchase_history, products)
+    user_index, product_index = indices
+    category_to_products, device_to_products = product_attributes
+    user_factors, item_factors = svd_factors
 
     recommendations = recommend_products_hybrid(
-        example_user_id, example_season_input, users, products, contextual_signals, browsing_history,
-        purchase_history, popular_products, user_factors, item_factors, user_index,
-        product_index, user_profiles, product_feature_vectors
+        example_user_id, example_season_input, current_day, users, category_to_products, device_to_products,
+        contextual_signals, browsing_history, purchase_history, popular_products, user_factors, item_factors,
+        user_index, product_index, index_to_product, user_profiles, normalized_feature_matrix
     )
     assert isinstance(recommendations, list)
     assert len(recommendations) > 0  # Ensure at least one recommendation is generated
@@ -208,25 +621,48 @@ def test_recommend_products_hybrid_specific_recommendations(data, example_user_i
 
 
 @patch("recommendation_system.main.redis_client.get")
-def test_recommend_products_hybrid_cached(mock_redis_get, data, example_user_id, example_season_input):
+def test_recommend_products_hybrid_cached(mock_redis_get, data, indices, index_to_product, product_attributes,
+                                          user_profiles, normalized_feature_matrix, svd_factors, popular_products,
+                                          current_day, example_user_id, example_season_input):
     """Test if cached recommendations are retrieved correctly."""
     mock_redis_get.return_value = json.dumps(([1.0, 2.0], [3.0, 4.0]))
-
     users, products, browsing_history, purchase_history, contextual_signals = data
-    user_index, product_index = build_index(users, products)
-    all_tags, all_categories = extract_tags_and_categories(products)
-    product_feature_vectors = {product_id: create_product_feature_vector(product, all_tags, all_categories)
-                               for product_id, product in products.items()}
-    user_profiles = compute_user_profiles_parallel(users.keys(), browsing_history, purchase_history,
-                                                   product_feature_vectors)
-    user_item_matrix = create_sparse_user_item_matrix(purchase_history, user_index, product_index)
-    user_factors, item_factors = get_svd_factors(user_item_matrix)
-    popular_products = compute_product_popularity(purchase_history, products)
+    user_index, product_index = indices
+    category_to_products, device_to_products = product_attributes
+    user_factors, item_factors = svd_factors
 
     recommendations = recommend_products_hybrid(
-        example_user_id, example_season_input, users, products, contextual_signals, browsing_history,
-        purchase_history, popular_products, user_factors, item_factors, user_index,
-        product_index, user_profiles, product_feature_vectors
+        example_user_id, example_season_input, current_day, users, category_to_products, device_to_products,
+        contextual_signals, browsing_history, purchase_history, popular_products, user_factors, item_factors,
+        user_index, product_index, index_to_product, user_profiles, normalized_feature_matrix
     )
     assert isinstance(recommendations, list)
     assert len(recommendations) > 0  # Ensure recommendations are generated
+
+
+def test_generate_recommendations_parallel_matches_hybrid(data, indices, index_to_product, product_attributes,
+                                                          user_profiles, normalized_feature_matrix, svd_factors,
+                                                          popular_products, current_day, example_season_input):
+    """Test if batch recommendations match the per-user hybrid recommendations."""
+    users, products, browsing_history, purchase_history, contextual_signals = data
+    user_index, product_index = indices
+    category_to_products, device_to_products = product_attributes
+    user_factors, item_factors = svd_factors
+
+    for user_id in users:
+        clear_cache_for_user(user_id)
+    batch_recommendations = generate_recommendations_parallel(
+        users, example_season_input, current_day, category_to_products, device_to_products, contextual_signals,
+        browsing_history, purchase_history, popular_products, user_factors, item_factors, user_index, product_index,
+        index_to_product, user_profiles, normalized_feature_matrix
+    )
+    assert set(batch_recommendations) == set(users)
+
+    for user_id in users:
+        clear_cache_for_user(user_id)
+        recommendations = recommend_products_hybrid(
+            user_id, example_season_input, current_day, users, category_to_products, device_to_products,
+            contextual_signals, browsing_history, purchase_history, popular_products, user_factors, item_factors,
+            user_index, product_index, index_to_product, user_profiles, normalized_feature_matrix
+        )
+        assert recommendations == batch_recommendations[user_id]
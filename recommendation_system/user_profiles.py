@@ -1,66 +1,141 @@
-import json
+import hashlib
 import logging
-import sys
-from concurrent.futures import as_completed, ProcessPoolExecutor
 
 import numpy as np
 import redis
+from scipy.sparse import coo_matrix, csr_matrix, issparse
 
-from .setup import redis_client
+from .data_loading import build_index_lookup
+from .feature_engineering import l2_normalize
+from .matrix_factorization import matrix_fingerprint
+from .setup import binary_redis_client
 
 
-def create_user_profile(user_id, browsing_history, purchase_history, product_feature_vectors):
-    """Creates a user profile based on browsing and purchase history."""
-    interacted_products = set()
-    if user_id in browsing_history:
-        interacted_products.update([product_id for product_id, _ in browsing_history[user_id]])
-    if user_id in purchase_history:
-        interacted_products.update([product_id for product_id, _, _ in purchase_history[user_id]])
+_NO_PRODUCTS = np.empty(0, dtype=np.int64)
 
-    user_profile = np.zeros(len(product_feature_vectors[next(iter(product_feature_vectors))]))
-    for product_id in interacted_products:
-        user_profile += product_feature_vectors[product_id]
 
-    if len(interacted_products) > 0:
-        user_profile /= len(interacted_products)
+def _product_rows(product_ids, product_index, product_row_lookup=None):
+    """Maps an array of product ids to their feature matrix rows, with -1 for unknown products."""
+    if product_row_lookup is None or product_ids.dtype.kind not in "iu":
+        return np.fromiter((product_index.get(product_id, -1) for product_id in product_ids.tolist()), dtype=np.intp,
+                           count=len(product_ids))
 
-    return user_profile
+    # One vectorized gather through the lookup table replaces a dict lookup per product
+    in_range = (product_ids >= 0) & (product_ids < len(product_row_lookup))
+    rows = np.full(len(product_ids), -1, dtype=np.intp)
+    rows[in_range] = product_row_lookup[product_ids[in_range]]
+    return rows
 
 
-def get_user_profile(user_id, browsing_history, purchase_history, product_feature_vectors):
-    """Retrieves or computes and caches the user profile."""
-    cache_key = f"user_profile:{user_id}"
+def _history_fingerprint(browsed_product_ids, purchased_product_ids):
+    """Returns a stable digest of the product ids a user browsed and purchased."""
+    digest = hashlib.blake2b(digest_size=8)
+    for product_ids in (browsed_product_ids, purchased_product_ids):
+        digest.update(f"{product_ids.dtype.str}:{len(product_ids)}:".encode())
+        digest.update(np.ascontiguousarray(product_ids).tobytes())
+    return digest.hexdigest()
+
+
+def _user_profile_cache_key(user_id, fingerprint, history_fingerprint):
+    """Returns the cache key of a user profile built from the given history and the feature matrix fingerprint."""
+    return f"user_profile_unit_f16:{user_id}:{fingerprint}:{history_fingerprint}"
+
+
+def _build_interaction_matrix(users, browsed_product_ids, purchased_product_ids, product_index):
+    """Builds a binary CSR matrix of the distinct products each of the given users interacted with.
+
+    Returns the matrix, whose rows follow users, and the users whose histories reference unknown products; their
+    rows are left empty.
+    """
+    histories = []
+    history_lengths = []
+    for user_id in users:
+        browsed = browsed_product_ids.get(user_id, _NO_PRODUCTS)
+        purchased = purchased_product_ids.get(user_id, _NO_PRODUCTS)
+        histories.extend((browsed, purchased))
+        history_lengths.append(len(browsed) + len(purchased))
+
+    rows = np.repeat(np.arange(len(users)), history_lengths)
+    history_product_ids = np.concatenate(histories) if histories else _NO_PRODUCTS
+    cols = _product_rows(history_product_ids, product_index, build_index_lookup(product_index))
+
+    failed_rows = np.unique(rows[cols < 0])
+    valid = ~np.isin(rows, failed_rows)
+    interaction_matrix = coo_matrix((np.ones(np.count_nonzero(valid), dtype=np.float32), (rows[valid], cols[valid])),
+                                    shape=(len(users), len(product_index))).tocsr()
+    interaction_matrix.data[:] = 1  # Repeated interactions with a product count once
+    return interaction_matrix, [users[row] for row in failed_rows]
+
+
+def _create_user_profiles(users, browsed_product_ids, purchased_product_ids, product_feature_matrix, product_index,
+                          user_profiles, user_index):
+    """Creates the profiles of the given users with one sparse product straight into their rows of user_profiles.
+
+    Returns the users whose profile was created; the rows of users whose profile fails are left empty.
+    """
+    interaction_matrix, failed_users = _build_interaction_matrix(users, browsed_product_ids, purchased_product_ids,
+                                                                 product_index)
+    for user_id in failed_users:
+        logging.error(f"Error computing profile for user {user_id}: unknown product in history")
+
+    # Summing each user's interacted feature rows is a single sparse-matrix product for the whole batch
+    summed_features = interaction_matrix @ product_feature_matrix
+    if issparse(summed_features):
+        summed_features = summed_features.toarray()
+    user_rows = np.fromiter((user_index[user_id] for user_id in users), dtype=np.intp, count=len(users))
+    user_profiles[user_rows] = l2_normalize(summed_features)
+
+    failed_users = set(failed_users)
+    return [user_id for user_id in users if user_id not in failed_users]
+
+
+def compute_user_profiles(user_index, browsed_product_ids, purchased_product_ids, product_feature_matrix,
+                          product_index):
+    """Compute the profiles of all users as one (U, D) matrix whose rows follow user_index, caching only the misses.
+
+    Profiles are cached per history, so only users whose interactions changed since the last run are recomputed.
+    """
+    users = list(user_index)
+    num_features = product_feature_matrix.shape[1]
+    user_profiles = np.zeros((len(user_index), num_features), dtype=np.float32)
+    # Keying on the feature matrix keeps profiles with added, reordered or retagged columns from being served
+    fingerprint = matrix_fingerprint(product_feature_matrix if issparse(product_feature_matrix)
+                                     else csr_matrix(product_feature_matrix))
+
+    cache_keys = {user_id: _user_profile_cache_key(user_id, fingerprint, _history_fingerprint(
+        browsed_product_ids.get(user_id, _NO_PRODUCTS), purchased_product_ids.get(user_id, _NO_PRODUCTS)))
+        for user_id in users}
 
     try:
-        cached_profile = redis_client.get(cache_key)
-        if cached_profile:
-            return np.array(json.loads(cached_profile))
+        cached_profiles = binary_redis_client.mget(list(cache_keys.values()))
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}. Falling back to computing user profiles without caching.")
+        _create_user_profiles(users, browsed_product_ids, purchased_product_ids, product_feature_matrix,
+                              product_index, user_profiles, user_index)
+        return user_profiles
+
+    missing_users = []
+    for user_id, cached_profile in zip(users, cached_profiles):
+        # A trailing all-zero column leaves the fingerprint unchanged, so a payload of another length is a miss too
+        if cached_profile and len(cached_profile) == num_features * np.dtype(np.float16).itemsize:
+            user_profiles[user_index[user_id]] = np.frombuffer(cached_profile, dtype=np.float16)
+        else:
+            missing_users.append(user_id)
+
+    if not missing_users:
+        return user_profiles
 
-        user_profile = create_user_profile(user_id, browsing_history, purchase_history, product_feature_vectors)
-        redis_client.setex(cache_key, 86400, json.dumps(user_profile.tolist()))  # Cache for 24 hours
-        return user_profile
+    created_users = _create_user_profiles(missing_users, browsed_product_ids, purchased_product_ids,
+                                          product_feature_matrix, product_index, user_profiles, user_index)
 
+    try:
+        # float16 halves the float32 payload while keeping a relative precision of about 1e-3 for every component
+        with binary_redis_client.pipeline(transaction=False) as pipe:
+            for user_id in created_users:
+                pipe.setex(cache_keys[user_id], 86400,
+                           user_profiles[user_index[user_id]].astype(np.float16).tobytes())
+            pipe.execute()  # Cache for 24 hours
     except redis.RedisError as e:
-        logging.error(f"Redis error: {e}. Falling back to computing user profile without caching.")
-        return create_user_profile(user_id, browsing_history, purchase_history, product_feature_vectors)
-
-
-def compute_user_profiles_parallel(users, browsing_history, purchase_history, product_feature_vectors):
-    """Compute user profiles in parallel."""
-    if 'pytest' in sys.modules:
-        return {user_id: get_user_profile(user_id, browsing_history, purchase_history, product_feature_vectors) for
-                user_id in users}
-    user_profiles = {}
-    with ProcessPoolExecutor() as executor:
-        futures = {
-            executor.submit(get_user_profile, user_id, browsing_history, purchase_history,
-                            product_feature_vectors): user_id
-            for user_id in users
-        }
-        for future in as_completed(futures):
-            user_id = futures[future]
-            try:
-                user_profiles[user_id] = future.result()
-            except Exception as e:
-                logging.error(f"Error computing profile for user {user_id}: {e}")
+        logging.error(f"Redis error: {e}. User profiles were computed but not cached.")
+
     return user_profiles